@@ -10,7 +10,130 @@ Example usage:
 """
 
 import argparse
+import contextlib
+import io
+import os
 import sqlite3
+import struct
+import sys
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+# Translation table marking high bytes of LDR instructions using PC+imm (1)
+# and of Thumb-2 32-bit instructions first halfword (2)
+LDR_PC_MARKS = bytes(
+    1 if (b & 0xF8) == 0x48 else 2 if (b & 0xE0) == 0xE0 else 0 for b in range(256)
+)
+
+# Thumb instructions handled while following a register
+OP_UNKNOWN, OP_LDR, OP_STR, OP_STRH, OP_STRB, OP_LDR_PC, OP_SUBS, OP_MOVS = range(8)
+OP_PATTERNS = [
+    (0xF800, 0x6800, OP_LDR),
+    (0xF800, 0x6000, OP_STR),
+    (0xF800, 0x8000, OP_STRH),
+    (0xF800, 0x7000, OP_STRB),
+    (0xF800, 0x4800, OP_LDR_PC),
+    (0xFE00, 0x1A00, OP_SUBS),
+    (0xF800, 0x2000, OP_MOVS),
+]
+
+# Immediate offset shift and access type of LDR/STR reg+imm instructions
+OP_MEM_ACCESS = {
+    OP_LDR: (2, "read"),
+    OP_STR: (2, "write"),
+    OP_STRH: (1, "write"),
+    OP_STRB: (0, "write"),
+}
+
+# Dispatch table mapping the top 11 bits of an instruction to its tag
+# All patterns masks fit in these bits, Thumb-2 halfwords are unknown
+OP_TAGS = bytes(
+    next(
+        (tag for mask, value, tag in OP_PATTERNS if (i << 5) & mask == value),
+        OP_UNKNOWN,
+    )
+    for i in range(2048)
+)
+
+
+def find_ldr_pc_offsets(firmware: bytes):
+    """
+    Yield offsets of halfwords matching LDR instruction using PC+imm
+
+    Halfwords following a Thumb-2 first halfword are skipped.
+    Slicing, translating and searching all run in C, so Python only iterates
+    on candidates rather than on every halfword of the firmware.
+    """
+    marks = firmware[1::2].translate(LDR_PC_MARKS)
+
+    # Verify that previous instruction is not Thumb-2, else we might be
+    # decoding half of a 32-bit instruction
+    marks = marks.replace(b"\x02\x01", b"\x02\x00")
+
+    index = marks.find(1, 1)  # first halfword has no previous instruction
+    while index != -1:
+        yield index * 2
+        index = marks.find(1, index + 1)
+
+
+def firmware_view(firmware: bytes, fmt: str) -> memoryview:
+    """
+    Get firmware as little-endian halfwords ("H") or words ("I")
+
+    Firmware is not copied on little-endian hosts. Trailing bytes not filling
+    a whole item are dropped.
+    """
+    size = len(firmware) - len(firmware) % struct.calcsize(fmt)
+    if sys.byteorder == "little":
+        return memoryview(firmware)[:size].cast(fmt)
+    items = array(fmt, firmware[:size])
+    items.byteswap()
+    return memoryview(items)
+
+
+def find_register_accesses(hw: memoryview, index: int, rd: int, data: int, regs: set):
+    """
+    Follow register rd holding data, starting from halfword index
+
+    Adds peripheral accesses to regs until the address is lost or an unknown
+    instruction is met.
+    """
+    # Find following LDR/STR rd+imm which does the peripheral access
+    # ARM Cortex-M peripherals are mapped at 0x40000000-0x60000000, see
+    # https://developer.arm.com/documentation/dui0552/a/the-cortex-m3-processor/memory-model
+    regmask = 1 << rd  # one bit per register r0-r7 containing addr
+    for index2 in range(index, len(hw)):
+        if not regmask:
+            break  # lost addr
+
+        instr2 = hw[index2]
+        tag = OP_TAGS[instr2 >> 5]
+        if tag == OP_UNKNOWN:
+            break  # unknown instruction or Thumb-2, stop
+        elif tag in OP_MEM_ACCESS:
+            # Found LDR/STR/STRH/STRB reg+imm, verify that it uses rd
+            rn2 = (instr2 >> 3) & 0x07
+            if (regmask >> rn2) & 1:
+                shift, access = OP_MEM_ACCESS[tag]
+                addr = data + (((instr2 >> 6) & 0x1F) << shift)
+                if 0x40000000 <= addr < 0x60000000 or 0xA0000000 <= addr < 0xE0000000:
+                    regs.add((addr, access))
+            elif tag == OP_LDR:
+                # LDR overwrites its destination register
+                rd2 = (instr2 >> 0) & 0x07
+                regmask &= ~(1 << rd2)
+        elif tag == OP_LDR_PC:
+            # Other instruction: LDR PC+imm
+            rd2 = (instr2 >> 8) & 0x07
+            regmask &= ~(1 << rd2)
+        elif tag == OP_SUBS:
+            # Other instruction: SUBS
+            rd2 = (instr2 >> 0) & 0x7
+            regmask &= ~(1 << rd2)
+        elif tag == OP_MOVS:
+            # Other instruction: MOVS imm
+            rd2 = (instr2 >> 8) & 0x07
+            regmask &= ~(1 << rd2)
 
 
 def find_used_registers(firmware: bytes) -> set:
@@ -23,170 +146,117 @@ def find_used_registers(firmware: bytes) -> set:
     """
     # NOTE: maybe use a disassembler (e.g. capstone)
     regs = set()
-    for fw_offset in range(2, len(firmware), 2):
-        # Match LDR instruction using PC+imm
-        instr = int.from_bytes(firmware[fw_offset : fw_offset + 2], "little")
-        if (instr & 0xF800) != 0x4800:
-            continue
-
-        # Verify that previous instruction is not Thumb-2, else we might be
-        # decoding half of a 32-bit instruction
-        prev_instr = int.from_bytes(firmware[fw_offset - 2 : fw_offset], "little")
-        if (prev_instr & 0xE000) == 0xE000:
-            continue
+    hw = firmware_view(firmware, "H")
+    words = firmware_view(firmware, "I")
+    for fw_offset in find_ldr_pc_offsets(firmware):
+        instr = hw[fw_offset >> 1]
 
         # Get data and destination register rd
         rb = (instr & 0xFF) << 2
         rd = (instr >> 8) & 0x07
         data_offset = (fw_offset + rb) // 4 * 4 + 4
-        data = int.from_bytes(firmware[data_offset : data_offset + 4], "little")
-
-        # Find following LDR/STR rd+imm which does the peripheral access
-        # ARM Cortex-M peripherals are mapped at 0x40000000-0x60000000, see
-        # https://developer.arm.com/documentation/dui0552/a/the-cortex-m3-processor/memory-model
-        registers_containing_addr = [rd]
-        for fw_offset2 in range(fw_offset + 2, len(firmware), 2):
-            if not registers_containing_addr:
-                break  # lost addr
-
-            instr2 = int.from_bytes(firmware[fw_offset2 : fw_offset2 + 2], "little")
-            if (prev_instr & 0xE000) == 0xE000:
-                break  # don't handle Thumb-2
-
-            if (instr2 & 0xF800) == 0x6800:
-                # Found LDR reg+imm, verify that it uses rd
-                rd2 = (instr2 >> 0) & 0x07
-                rn2 = (instr2 >> 3) & 0x07
-                if rn2 in registers_containing_addr:
-                    addr = data + (((instr2 >> 6) & 0x1F) << 2)
-                    if (
-                        0x40000000 <= addr < 0x60000000
-                        or 0xA0000000 <= addr < 0xE0000000
-                    ):
-                        regs.add((addr, "read"))
-                elif rd2 in registers_containing_addr:
-                    registers_containing_addr.remove(rd2)
-            elif (instr2 & 0xF800) == 0x6000:
-                # Found STR reg+imm, verify that it uses rd
-                rn2 = (instr2 >> 3) & 0x07
-                if rn2 in registers_containing_addr:
-                    addr = data + (((instr2 >> 6) & 0x1F) << 2)
-                    if (
-                        0x40000000 <= addr < 0x60000000
-                        or 0xA0000000 <= addr < 0xE0000000
-                    ):
-                        regs.add((addr, "write"))
-            elif (instr2 & 0xF800) == 0x8000:
-                # Found STRH reg+imm, verify that it uses rd
-                rn2 = (instr2 >> 3) & 0x07
-                if rn2 in registers_containing_addr:
-                    addr = data + (((instr2 >> 6) & 0x1F) << 1)
-                    if (
-                        0x40000000 <= addr < 0x60000000
-                        or 0xA0000000 <= addr < 0xE0000000
-                    ):
-                        regs.add((addr, "write"))
-            elif (instr2 & 0xF800) == 0x7000:
-                # Found STRB reg+imm, verify that it uses rd
-                rn2 = (instr2 >> 3) & 0x07
-                if rn2 in registers_containing_addr:
-                    addr = data + ((instr2 >> 6) & 0x1F)
-                    if (
-                        0x40000000 <= addr < 0x60000000
-                        or 0xA0000000 <= addr < 0xE0000000
-                    ):
-                        regs.add((addr, "write"))
-            elif (instr2 & 0xF800) == 0x4800:
-                # Other instruction: LDR PC+imm
-                rd2 = (instr2 >> 8) & 0x07
-                if rd2 in registers_containing_addr:
-                    registers_containing_addr.remove(rd2)
-            elif (instr2 & 0xFE00) == 0x1A00:
-                # Other instruction: SUBS
-                rd2 = (instr2 >> 0) & 0x7
-                if rd2 in registers_containing_addr:
-                    registers_containing_addr.remove(rd2)
-            elif (instr2 & 0xF800) == 0x2000:
-                # Other instruction: MOVS imm
-                rd2 = (instr2 >> 8) & 0x07
-                if rd2 in registers_containing_addr:
-                    registers_containing_addr.remove(rd2)
-            else:
-                # Unknown instruction, stop
-                break
+        if (data_offset >> 2) < len(words):
+            data = words[data_offset >> 2]
+        else:
+            # Data is truncated at the end of the firmware
+            data = int.from_bytes(firmware[data_offset : data_offset + 4], "little")
+
+        find_register_accesses(hw, (fw_offset >> 1) + 1, rd, data, regs)
 
     return regs
 
 
-def dict_intersection_merge(d1: dict, d2: dict) -> dict:
-    """
-    Intersect two dicts on keys, and merge values (dict of lists)
-    """
-    if d1 is None:
-        return d2  # 'None' means 'all' in our case
-    d1 = d1.copy()
-    for key in [k for k in d1.keys()]:
-        if key not in d2:
-            d1.pop(key)
-        else:
-            d1[key] += d2[key]
-    return d1
+# Registers found at each address, shared between firmwares of a process
+REGISTERS_CACHE = {}
 
 
-def find_devices_by_register(cursor: sqlite3.Cursor, addr: int, access: str) -> dict:
+def find_registers_by_addresses(cursor: sqlite3.Cursor, addrs: set) -> dict:
     """
-    Get devices matching a given register
+    Get (device_id, peripheral_name, register_name) of registers at each addr
+
+    Addresses missing from cache are looked up all at once, using a temporary
+    table joined with registers in a single query.
     """
-    res = cursor.execute(
-        "SELECT device_id, peripheral_name, register_name "
-        "FROM register "
-        "JOIN peripheral ON peripheral_id == peripheral.id "
-        "WHERE register_address <= ?1 "
-        "AND register_address + 32 > ?1 "  # query performance optimisation
-        "AND register_address + register_size / 8 > ?1",
-        (addr,),
-    )
-    return {dev_id: [attr + [access]] for dev_id, *attr in res.fetchall()}
+    missing = [(addr,) for addr in addrs if addr not in REGISTERS_CACHE]
+    if missing:
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS probe (addr INTEGER NOT NULL)")
+        cursor.execute("DELETE FROM probe")
+        cursor.executemany("INSERT INTO probe (addr) VALUES (?)", missing)
+        res = cursor.execute(
+            "SELECT addr, device_id, peripheral_name, register_name "
+            "FROM probe "
+            "CROSS JOIN register ON register_address <= addr "  # probe first
+            "AND register_address > addr - 32 "  # query performance optimisation
+            "AND register_address + register_size / 8 > addr "
+            "JOIN peripheral ON peripheral_id == peripheral.id"
+        )
+        rows = res.fetchall()
+
+        # Probe writes opened a transaction, end it to release database lock
+        cursor.connection.commit()
+
+        for (addr,) in missing:
+            REGISTERS_CACHE[addr] = []
+        for addr, *attr in rows:
+            REGISTERS_CACHE[addr].append(attr)
+    return {addr: REGISTERS_CACHE[addr] for addr in addrs}
 
 
 def find_devices(cursor: sqlite3.Cursor, regs: set) -> dict:
     """
     Get devices matching given registers
     """
-    matchs = None
+    registers = find_registers_by_addresses(cursor, {addr for addr, _ in regs})
+
+    # Intersect devices on each register, skipping registers that would empty
+    # the intersection, then merge matched registers of remaining devices
+    dev_ids = None
+    matchs = []
     for addr, access in list(regs):
-        m = find_devices_by_register(cursor, addr, access)
+        m = {dev_id: attr + [access] for dev_id, *attr in registers[addr]}
         if not m:
             print(f"No devices match register 0x{addr:08x} (read), skipping")
             continue
-        new_matchs = dict_intersection_merge(matchs, m)
-        if not new_matchs:
+        new_dev_ids = m.keys() if dev_ids is None else dev_ids & m.keys()
+        if not new_dev_ids:
             print(f"Intersection with register 0x{addr:08x} (read) is empty, skipping")
             continue
-        matchs = new_matchs
-    return matchs
+        dev_ids = new_dev_ids
+        matchs.append(m)
+    if not matchs:
+        return {}
+    return {
+        dev_id: [m[dev_id] for m in matchs] for dev_id in matchs[0] if dev_id in dev_ids
+    }
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument(
-        "filename",
-        nargs="+",
-        type=argparse.FileType("rb"),
-    )
-    args = parser.parse_args()
+# Read-only database cursor of each worker process, see open_database
+worker_cursor = None
+
 
-    # Open database
-    con = sqlite3.connect("database.db")
+def open_database() -> None:
+    """Open database read-only in worker process"""
+    global worker_cursor
+    con = sqlite3.connect("file:database.db?mode=ro", uri=True)
+    worker_cursor = con.cursor()
 
-    for f in args.filename:
-        cursor = con.cursor()
+
+def analyze_firmware(path: str) -> str:
+    """
+    Find devices that could run a firmware
+
+    Runs in a worker process and returns the printed report, so that reports
+    of firmwares analyzed in parallel are not mixed.
+    """
+    cursor = worker_cursor
+    with open(path, "rb") as f:
         firmware = f.read()
 
+    with contextlib.redirect_stdout(io.StringIO()) as out:
         # Disassemble to find registers reads/writes
         regs = find_used_registers(firmware)
 
-        print(f"=== {f.name} ===")
+        print(f"=== {path} ===")
         print(
             "Found addresses:",
             ", ".join([f"0x{addr:08x} ({access})" for addr, access in regs]),
@@ -206,3 +276,29 @@ if __name__ == "__main__":
             for p_name, reg_name, access in registers:
                 print(f"    {access} register {reg_name} of {p_name}")
             print()
+    return out.getvalue()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "filename",
+        nargs="+",
+    )
+    args = parser.parse_args()
+    for path in args.filename:
+        if not os.path.isfile(path) or not os.access(path, os.R_OK):
+            parser.error(f"argument filename: can't open '{path}'")
+
+    # Check database before workers open it, to report errors clearly
+    try:
+        con = sqlite3.connect("file:database.db?mode=ro", uri=True)
+        con.execute("SELECT id FROM device LIMIT 1")
+        con.close()
+    except sqlite3.Error as e:
+        parser.error(f"can't open 'database.db': {e}")
+
+    # Analyze firmwares in parallel, each worker having its own connection
+    with ProcessPoolExecutor(initializer=open_database) as executor:
+        for report in executor.map(analyze_firmware, args.filename):
+            print(report, end="")
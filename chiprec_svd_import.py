@@ -11,9 +11,15 @@ Example usage:
 """
 
 import argparse
+import collections
 import os
 import sqlite3
-import xml.etree.ElementTree as ET
+from concurrent.futures import Executor, ProcessPoolExecutor
+
+try:
+    from lxml import etree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
 
 SQL_SCHEMA = """
 CREATE TABLE IF NOT EXISTS "device" (
@@ -42,7 +48,11 @@ CREATE TABLE IF NOT EXISTS "register" (
     UNIQUE(register_name, peripheral_id)
 );
 
-CREATE INDEX IF NOT EXISTS "register_register_address_idx" ON register(register_address);
+-- Covering index, so chiprec register lookups never read the table itself
+DROP INDEX IF EXISTS "register_register_address_idx";
+CREATE INDEX IF NOT EXISTS "register_register_address_covering_idx" ON register(
+    register_address, register_size, peripheral_id, register_name
+);
 """
 
 
@@ -73,76 +83,161 @@ def xml_get_text_or(root, key: str, default="") -> str:
     return default
 
 
-def add_svd_to_database(cursor: sqlite3.Cursor, file) -> None:
+def xml_iter_events(file, events: tuple):
+    """Helper to stream XML events from a text file"""
+    parser = ET.XMLPullParser(events=events)
+    for chunk in iter(lambda: file.read(1 << 16), ""):
+        parser.feed(chunk)
+        yield from parser.read_events()
+    parser.close()
+    yield from parser.read_events()
+
+
+def parse_svd(file) -> tuple:
     """
-    Parse System View Description (SVD) and add peripherals to SQLite database
+    Parse System View Description (SVD) filename, device name, vendor and
+    peripherals
+
+    The SVD is streamed and each peripheral is cleared once parsed, so the
+    whole XML tree is never kept in memory.
+    Peripherals are (name, address, registers) with registers being
+    (name, address offset, size, access).
     """
     svd_filename = os.path.basename(file.name)
-    root = ET.parse(file).getroot()
-
-    # Collect peripherals offset
-    # This is needed to resolve derivedFrom later
+    device_name = None
+    device_vendor = ""
     peripherals_offset = {}
-    for peripheral in root.findall("./peripherals/peripheral"):
-        p_name = peripheral.find("name").text
-        p_offset = peripheral.find("./addressBlock/offset")
-        if p_offset is not None and p_offset.text is not None:
-            peripherals_offset[p_name] = int(p_offset.text, 0)
+    peripherals = []
+    depth = 0
+    for event, elem in xml_iter_events(file, ("start", "end")):
+        if event == "start":
+            depth += 1
+            continue
+        depth -= 1
 
-    # Save device
-    device_name = root.find("./name").text.strip()
-    device_vendor = xml_get_text_or(root, "./vendor")
-    cursor.execute(
-        "INSERT OR IGNORE INTO device (device_name, device_vendor, svd_filename) VALUES (?, ?, ?)",
-        (device_name, device_vendor, svd_filename),
-    )
-    res = cursor.execute("SELECT id FROM device WHERE device_name = ?", (device_name,))
-    (device_id,) = res.fetchone()
+        if depth == 1 and elem.tag == "name":
+            device_name = elem.text.strip()
+        elif depth == 1 and elem.tag == "vendor" and elem.text is not None:
+            device_vendor = elem.text.strip()
+        elif depth == 2 and elem.tag == "peripheral":
+            # Collect peripheral offset
+            # This is needed to resolve derivedFrom later
+            raw_name = elem.find("name").text
+            p_offset = elem.find("./addressBlock/offset")
+            if p_offset is not None and p_offset.text is not None:
+                peripherals_offset[raw_name] = int(p_offset.text, 0)
 
-    # Collect peripherals
-    for peripheral in root.findall("./peripherals/peripheral"):
-        # Get peripheral name and address
-        p_name = peripheral.find("name").text.strip().upper()
-        base_addr = peripheral.find("baseAddress")
-        if base_addr is None or base_addr.text is None:
-            print(f"{svd_filename}/{p_name}: missing base address, skipping")
-            continue
-        p_address = int(base_addr.text, 0)
-        derived_from = peripheral.get("derivedFrom", p_name)
-        p_address += peripherals_offset.get(derived_from, 0)
+            # Get peripheral name and address
+            p_name = raw_name.strip().upper()
+            base_addr = elem.find("baseAddress")
+            if base_addr is None or base_addr.text is None:
+                print(f"{svd_filename}/{p_name}: missing base address, skipping")
+                elem.clear()
+                continue
+            p_address = int(base_addr.text, 0)
+            derived_from = elem.get("derivedFrom", p_name)
+
+            # Collect registers
+            registers = []
+            for register in elem.findall("./registers/register"):
+                r_name = register.find("name").text
+                r_offset = int(register.find("addressOffset").text, 0)
+
+                # Get register size and access
+                r_size = int(xml_get_text_or(register, "size", "32"), 0)
+                r_access = xml_get_text_or(register, "access", "read-write").lower()
+                r_access = fix_reg_access_typo(r_access)
+                registers.append((r_name, r_offset, r_size, r_access))
+
+            peripherals.append((p_name, p_address, derived_from, registers))
+            elem.clear()
+
+    # Resolve derivedFrom now that all peripherals offsets are known
+    peripherals = [
+        (p_name, p_address + peripherals_offset.get(derived_from, 0), registers)
+        for p_name, p_address, derived_from, registers in peripherals
+    ]
+    return svd_filename, device_name, device_vendor, peripherals
+
+
+def load_svd(path: str) -> tuple:
+    """
+    Open and parse System View Description (SVD)
+
+    Runs in a worker process, only plain tuples are sent back.
+    """
+    try:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            return parse_svd(f)
+    except Exception as e:
+        raise RuntimeError(f"Failed to load {path}") from e
+
+
+def load_svds(executor: Executor, paths: list, window: int):
+    """
+    Yield (path, parsed SVD) in order, parsing SVD in executor
+
+    At most window SVD are parsed ahead, so that parsed SVD do not pile up in
+    memory when database writes are slower.
+    """
+    pending = collections.deque()
+    for path in paths:
+        pending.append((path, executor.submit(load_svd, path)))
+        if len(pending) >= window:
+            path, future = pending.popleft()
+            yield path, future.result()
+    for path, future in pending:
+        yield path, future.result()
+
+
+def add_svd_to_database(cursor: sqlite3.Cursor, svd: tuple) -> None:
+    """
+    Add parsed System View Description (SVD) peripherals to SQLite database
+    """
+    svd_filename, device_name, device_vendor, peripherals = svd
 
-        # Save peripheral
+    # Save device
+    if sqlite3.sqlite_version_info >= (3, 35, 0):
+        # Get back id in the same statement, even if device already exists
+        res = cursor.execute(
+            "INSERT INTO device (device_name, device_vendor, svd_filename) VALUES (?, ?, ?) "
+            "ON CONFLICT(device_name) DO UPDATE SET device_name = excluded.device_name "
+            "RETURNING id",
+            (device_name, device_vendor, svd_filename),
+        )
+    else:
         cursor.execute(
-            "INSERT OR IGNORE INTO peripheral (device_id, peripheral_name, peripheral_address) "
-            "VALUES (?, ?, ?)",
-            (device_id, p_name, p_address),
+            "INSERT OR IGNORE INTO device (device_name, device_vendor, svd_filename) VALUES (?, ?, ?)",
+            (device_name, device_vendor, svd_filename),
         )
         res = cursor.execute(
-            "SELECT id FROM peripheral WHERE peripheral_name = ? AND device_id = ?",
-            (
-                p_name,
-                device_id,
-            ),
+            "SELECT id FROM device WHERE device_name = ?", (device_name,)
         )
-        (peripheral_id,) = res.fetchone()
-
-        # Collect registers
-        for register in peripheral.findall("./registers/register"):
-            r_name = register.find("name").text
-            r_address = p_address + int(register.find("addressOffset").text, 0)
+    (device_id,) = res.fetchone()
 
-            # Get register size and access
-            r_size = int(xml_get_text_or(register, "size", "32"), 0)
-            r_access = xml_get_text_or(register, "access", "read-write").lower()
-            r_access = fix_reg_access_typo(r_access)
+    # Save peripherals, then get back all their ids at once
+    cursor.executemany(
+        "INSERT OR IGNORE INTO peripheral (device_id, peripheral_name, peripheral_address) "
+        "VALUES (?, ?, ?)",
+        [(device_id, p_name, p_address) for p_name, p_address, _ in peripherals],
+    )
+    res = cursor.execute(
+        "SELECT peripheral_name, id FROM peripheral WHERE device_id = ?",
+        (device_id,),
+    )
+    peripherals_id = dict(res.fetchall())
 
-            # Save register
-            cursor.execute(
-                "INSERT OR IGNORE INTO register (peripheral_id, register_name, "
-                "register_access, register_address, register_size) "
-                "VALUES (?, ?, ?, ?, ?)",
-                (peripheral_id, r_name, r_access, r_address, r_size),
-            )
+    # Save registers
+    cursor.executemany(
+        "INSERT OR IGNORE INTO register (peripheral_id, register_name, "
+        "register_access, register_address, register_size) "
+        "VALUES (?, ?, ?, ?, ?)",
+        [
+            (peripherals_id[p_name], r_name, r_access, p_address + r_offset, r_size)
+            for p_name, p_address, registers in peripherals
+            for r_name, r_offset, r_size, r_access in registers
+        ],
+    )
 
 
 if __name__ == "__main__":
@@ -154,14 +249,34 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     # Init database
+    # Write-ahead log avoids syncing the whole database on each SVD commit
     con = sqlite3.connect("database.db")
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
     con.executescript(SQL_SCHEMA)
 
-    for path in args.filename:
-        cursor = con.cursor()
-        try:
-            with open(path, "r", encoding="utf-8", errors="replace") as f:
-                add_svd_to_database(cursor, f)
-        except Exception as e:
-            raise RuntimeError(f"Failed to load {path}") from e
+    try:
+        # Parse SVD in parallel, as SQLite writes are serialized anyway
+        with ProcessPoolExecutor() as executor:
+            try:
+                window = 4 * (os.cpu_count() or 1)
+                for path, svd in load_svds(executor, args.filename, window):
+                    cursor = con.cursor()
+                    try:
+                        add_svd_to_database(cursor, svd)
+                    except Exception as e:
+                        raise RuntimeError(f"Failed to load {path}") from e
+                    con.commit()
+            except BaseException:
+                # Do not wait for pending SVD to be parsed
+                executor.shutdown(cancel_futures=True)
+                raise
+
+        # Gather statistics for query planner
+        con.execute("ANALYZE")
         con.commit()
+    finally:
+        # Go back to a single file database for chiprec, even on failure
+        con.rollback()
+        con.execute("PRAGMA journal_mode=DELETE")
+        con.close()
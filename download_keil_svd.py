@@ -10,8 +10,8 @@ Also see https://github.com/cmsis-svd/cmsis-svd-data/issues/44
 
 import os
 import re
+import tempfile
 import zipfile
-from io import BytesIO
 
 import requests
 
@@ -44,17 +44,26 @@ def get_vendor_packs_url():
 def fetch_extract_pack(url: str, out_dir: str):
     """Fetch pack and extract SVD descriptions"""
     os.makedirs(out_dir, exist_ok=True)
-    r = requests.get(url, headers={"User-Agent": USER_AGENT})
-    r.raise_for_status()
-    pack_zip = zipfile.ZipFile(BytesIO(r.content))
-    svd_paths = [p for p in pack_zip.namelist() if p[-4:].lower() in [".svd", ".xml"]]
-    for path in svd_paths:
-        svd_basename = os.path.basename(path)
-        svd_content = pack_zip.open(path).read()
-        if b"<device" not in svd_content or b"<peripherals" not in svd_content:
-            continue  # not a SVD
-        print(f"Writing {out_dir}{svd_basename}")
-        open(f"{out_dir}{svd_basename}", "wb").write(svd_content.strip())
+    # Stream pack to a temporary file, only small packs are kept in memory
+    with tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024) as pack_file:
+        with requests.get(url, headers={"User-Agent": USER_AGENT}, stream=True) as r:
+            r.raise_for_status()
+            for chunk in r.iter_content(chunk_size=1024 * 1024):
+                pack_file.write(chunk)
+        pack_file.seek(0)
+
+        with zipfile.ZipFile(pack_file) as pack_zip:
+            svd_paths = [
+                p for p in pack_zip.namelist() if p[-4:].lower() in [".svd", ".xml"]
+            ]
+            for path in svd_paths:
+                svd_basename = os.path.basename(path)
+                svd_content = pack_zip.read(path)
+                if b"<device" not in svd_content or b"<peripherals" not in svd_content:
+                    continue  # not a SVD
+                print(f"Writing {out_dir}{svd_basename}")
+                with open(f"{out_dir}{svd_basename}", "wb") as f:
+                    f.write(svd_content.strip())
 
 
 if __name__ == "__main__":